@@ -10,9 +10,8 @@ def preprocess_brain():
     adata = anndata.read_h5ad("/nfs/turbo/umms-welchjd/yichen/data/scRNA/Braindev_full/Braindev_full.h5ad")
     root = "/nfs/turbo/umms-welchjd/yichen/data/scRNA/Braindev_full"
     
-    cell_labels = adata.obs["Class"].to_numpy()
-    adata.obs["clusters"] = cell_labels
-    cell_mask = ~( (cell_labels=="Bad cells") | (cell_labels=="Undefined") )
+    adata.obs["clusters"] = adata.obs["Class"].astype("category")
+    cell_mask = ~adata.obs["clusters"].isin(["Bad cells", "Undefined"]).to_numpy()
     adata = adata[cell_mask]
     
     #Preprocessing
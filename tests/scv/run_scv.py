@@ -1,6 +1,8 @@
 import anndata
 import scvelo as scv
 import numpy as np
+from scipy.sparse import issparse
+import joblib
 import os
 import argparse
 import time
@@ -9,22 +11,78 @@ parser = argparse.ArgumentParser('hyperparam')
 parser.add_argument('-i', '--input', type=str, default=None)
 parser.add_argument('-o', '--out_folder', type=str, default="results")
 parser.add_argument('-s', '--save', type=str, default=None)
+parser.add_argument('--n_jobs', type=int, default=None)
+parser.add_argument('--fast_graph', action='store_true')
+parser.add_argument('--checkpoint', type=str, default=None)
 args = parser.parse_args()
 
-def run_scv(adata):
-    t_start = time.time()
-    scv.tl.recover_dynamics(adata)
-    run_time = time.time() - t_start
+def save_dynamics(adata, path, run_time):
+    fit_var = adata.var[[key for key in adata.var if key.startswith('fit_')]]
+    fit_layers = {key: adata.layers[key] for key in adata.layers if key.startswith('fit_')}
+    # recover_dynamics also stores the per-gene loss curves in varm
+    fit_varm = {key: adata.varm[key] for key in ['loss'] if key in adata.varm}
+    joblib.dump((adata.obs_names, adata.var_names, fit_var, fit_layers, fit_varm,
+                 adata.uns['recover_dynamics'], run_time), path)
+
+def load_dynamics(adata, path):
+    obs_names, var_names, fit_var, fit_layers, fit_varm, params, run_time = joblib.load(path)
+    if not (adata.obs_names.equals(obs_names) and adata.var_names.equals(var_names)):
+        print('Warning: checkpoint does not match the input data. Refitting the dynamics.')
+        return None
+    for key in fit_var:
+        adata.var[key] = fit_var[key]
+    for key in fit_layers:
+        adata.layers[key] = fit_layers[key]
+    for key in fit_varm:
+        adata.varm[key] = fit_varm[key]
+    adata.uns['recover_dynamics'] = params
+    print(f'Loaded fitted dynamics from {path}')
+    return run_time
+
+def run_scv(adata, n_jobs=None, fast_graph=False, checkpoint=None):
+    n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+    for key in ['Ms', 'Mu']:
+        # without moments, recover_dynamics falls back to the raw counts
+        if key not in adata.layers:
+            continue
+        X = adata.layers[key]
+        if X.dtype == np.float64:
+            X = X.astype(np.float32)
+        # gene-major layout: each per-gene fit reads one contiguous column
+        adata.layers[key] = X.tocsc() if issparse(X) else np.asfortranarray(X)
+    run_time = None
+    if checkpoint is not None and os.path.exists(checkpoint):
+        run_time = load_dynamics(adata, checkpoint)
+    if run_time is None:
+        t_start = time.time()
+        scv.tl.recover_dynamics(adata, n_jobs=n_jobs, backend='loky', show_progress_bar=False)
+        run_time = time.time() - t_start
+        if checkpoint is not None:
+            save_dynamics(adata, checkpoint, run_time)
     scv.tl.velocity(adata, mode='dynamical')
-    scv.tl.velocity_graph(adata)
+    if fast_graph:
+        # only keep velocity genes with an at-least-median fit likelihood
+        ll = adata.var['fit_likelihood'].to_numpy()
+        vgenes = adata.var['velocity_genes'].to_numpy(dtype=bool) & ~np.isnan(ll)
+        if vgenes.any():
+            gene_subset = adata.var_names[vgenes & (ll >= np.median(ll[vgenes]))]
+        else:
+            print('Warning: no velocity genes with a fitted likelihood. Using all genes for the velocity graph.')
+            gene_subset = adata.var_names
+        scv.tl.velocity_graph(adata, gene_subset=gene_subset, n_jobs=n_jobs, approx=True)
+    else:
+        scv.tl.velocity_graph(adata, n_jobs=n_jobs)
     scv.tl.latent_time(adata)
     if(args.save is not None):
         adata.uns['fit_run_time'] = run_time
-        adata.write_h5ad(f'{args.out_folder}/{args.save}')
+        if args.save.endswith('.zarr'):
+            adata.write_zarr(f'{args.out_folder}/{args.save}')
+        else:
+            adata.write_h5ad(f'{args.out_folder}/{args.save}', compression='gzip')
     
     print(f"Total run time: {run_time}")
     print("---------------------------------------------------")
 
 adata = anndata.read_h5ad(args.input)
 os.makedirs(args.out_folder, exist_ok=True)
-run_scv(adata)
+run_scv(adata, args.n_jobs, args.fast_graph, args.checkpoint)
@@ -5,12 +5,14 @@ import numpy as np
 import torch
 import torch.nn as nn
 import pandas as pd
+import math
 import os
 import time
+from typing import Optional
 from velovae.plotting import plot_sig, plot_train_loss, plot_test_loss
 from .model_util import init_params, reinit_type_params
 from .model_util import convert_time, get_gene_index
-from .model_util import ode_br, encode_type, str2int, int2str
+from .model_util import ode_br, encode_type, str2int, int2str, group_quantile
 from .training_data import SCTimedData
 from .transition_graph import TransGraph
 from .velocity import rna_velocity_brode
@@ -18,6 +20,29 @@ P_MAX = 1e4
 GRAD_MAX = 1e7
 
 
+@torch.jit.script
+def _ode_risk_fn(u: torch.Tensor,
+                 s: torch.Tensor,
+                 uhat: torch.Tensor,
+                 shat: torch.Tensor,
+                 sigma_u: torch.Tensor,
+                 sigma_s: torch.Tensor,
+                 logsigma_u: torch.Tensor,
+                 logsigma_s: torch.Tensor,
+                 weight: Optional[torch.Tensor] = None,
+                 p_max: float = P_MAX):
+    # Scripted so that the elementwise ops are fused into fewer kernels
+    # The noise levels are given both directly and in log scale, as cached by the decoder.
+    neg_log_gaussian = 0.5*((uhat-u)/sigma_u).pow(2) \
+        + 0.5*((shat-s)/sigma_s).pow(2) \
+        + logsigma_u+logsigma_s+math.log(2*math.pi)
+    neg_log_gaussian = torch.clamp(neg_log_gaussian, -p_max, p_max)
+    if weight is not None:
+        neg_log_gaussian = neg_log_gaussian*weight.view(-1, 1)
+
+    return torch.mean(torch.sum(neg_log_gaussian, 1))
+
+
 class decoder(nn.Module):
     def __init__(self,
                  adata,
@@ -33,8 +58,6 @@ class decoder(nn.Module):
                  **kwargs):
         super(decoder, self).__init__()
 
-        U, S = adata.layers['Mu'][train_idx], adata.layers['Ms'][train_idx]
-        X = np.concatenate((U, S), 1)
         G = adata.n_vars
 
         t = adata.obs[tkey].to_numpy()[train_idx]
@@ -44,8 +67,8 @@ class decoder(nn.Module):
         cell_labels_int = str2int(cell_labels_raw, self.label_dic)
         cell_labels_int = cell_labels_int[train_idx]
         self.cell_labels_int = cell_labels_int
-        cell_types_int = str2int(self.cell_types, self.label_dic)
-        self.Ntype = len(cell_types_int)
+        self.Ntype = len(self.cell_types)
+        cell_types_int = np.arange(self.Ntype)  # encode_type numbers the unique types in order
 
         # Transition Graph
         partition_k = kwargs['partition_k'] if 'partition_k' in kwargs else 5
@@ -66,23 +89,22 @@ class decoder(nn.Module):
         par = np.argmax(w, 1)
         roots = np.where(par == np.array(range(len(par))))[0]
 
-        self.w = torch.tensor(w, device=device)
+        self.w = torch.as_tensor(w, device=device)
         self.par = torch.argmax(self.w, 1)
 
         # Dynamical Model Parameters
         if checkpoint is not None:
-            self.alpha = nn.Parameter(torch.empty(G, device=device).float())
-            self.beta = nn.Parameter(torch.empty(G, device=device).float())
-            self.gamma = nn.Parameter(torch.empty(G, device=device).float())
-            self.scaling = nn.Parameter(torch.empty(G, device=device).float())
-            self.sigma_u = nn.Parameter(torch.empty(G, device=device).float())
-            self.sigma_s = nn.Parameter(torch.empty(G, device=device).float())
+            self.alpha = nn.Parameter(torch.empty(G, dtype=torch.float32, device=device))
+            self.beta = nn.Parameter(torch.empty(G, dtype=torch.float32, device=device))
+            self.gamma = nn.Parameter(torch.empty(G, dtype=torch.float32, device=device))
+            self.scaling = nn.Parameter(torch.empty(G, dtype=torch.float32, device=device))
+            self.sigma_u = nn.Parameter(torch.empty(G, dtype=torch.float32, device=device))
+            self.sigma_s = nn.Parameter(torch.empty(G, dtype=torch.float32, device=device))
 
             self.load_state_dict(torch.load(checkpoint, map_location=device))
         else:
             # Dynamical Model Parameters
             U, S = adata.layers['Mu'][train_idx], adata.layers['Ms'][train_idx]
-            X = np.concatenate((U, S), 1)
 
             print("Initialization using type-specific dynamical model.")
 
@@ -99,11 +121,10 @@ class decoder(nn.Module):
                  sigma_u,
                  sigma_s,
                  T,
-                 Rscore) = init_params(X, p, fit_scaling=True)
+                 Rscore) = init_params(np.concatenate((U, S), 1), p, fit_scaling=True)
 
-            t_trans, dts = np.zeros((self.Ntype)), np.random.rand(self.Ntype, G)*0.01
-            for i, type_ in enumerate(cell_types_int):
-                t_trans[type_] = np.quantile(t[cell_labels_int == type_], 0.05)
+            t_trans = group_quantile(t, cell_labels_int, self.Ntype, 0.05)
+            dts = np.random.rand(self.Ntype, G)*0.01
             ts = t_trans.reshape(-1, 1) + dts
 
             alpha, beta, gamma, u0, s0 = reinit_type_params(U/scaling,
@@ -114,17 +135,27 @@ class decoder(nn.Module):
                                                             cell_types_int,
                                                             cell_types_int)
 
-            self.alpha = nn.Parameter(torch.tensor(np.log(alpha), device=device).float())
-            self.beta = nn.Parameter(torch.tensor(np.log(beta), device=device).float())
-            self.gamma = nn.Parameter(torch.tensor(np.log(gamma), device=device).float())
-            self.t_trans = nn.Parameter(torch.tensor(np.log(t_trans+1e-10), device=device).float())
-            self.u0_root = nn.Parameter(torch.tensor(np.log(u0[roots]*scaling), device=device).float())
-            self.s0_root = nn.Parameter(torch.tensor(np.log(s0[roots]), device=device).float())
-            self.register_buffer('scaling', torch.tensor(np.log(scaling), device=device).float())
-            self.register_buffer('sigma_u', torch.tensor(np.log(sigma_u), device=device).float())
-            self.register_buffer('sigma_s', torch.tensor(np.log(sigma_s), device=device).float())
+            self.alpha = nn.Parameter(torch.as_tensor(np.log(alpha), dtype=torch.float32, device=device))
+            self.beta = nn.Parameter(torch.as_tensor(np.log(beta), dtype=torch.float32, device=device))
+            self.gamma = nn.Parameter(torch.as_tensor(np.log(gamma), dtype=torch.float32, device=device))
+            self.t_trans = nn.Parameter(torch.as_tensor(np.log(t_trans+1e-10), dtype=torch.float32, device=device))
+            self.u0_root = nn.Parameter(torch.as_tensor(np.log(u0[roots]*scaling), dtype=torch.float32, device=device))
+            self.s0_root = nn.Parameter(torch.as_tensor(np.log(s0[roots]), dtype=torch.float32, device=device))
+            self.register_buffer('scaling', torch.as_tensor(np.log(scaling), dtype=torch.float32, device=device))
+            self.register_buffer('sigma_u', torch.as_tensor(np.log(sigma_u), dtype=torch.float32, device=device))
+            self.register_buffer('sigma_s', torch.as_tensor(np.log(sigma_s), dtype=torch.float32, device=device))
 
         self.t_trans.requires_grad = False
+        self.refresh_const()
+
+    def refresh_const(self):
+        """Cache the exponentials of the parameters that are not trained.
+        Must be called again whenever t_trans, scaling, sigma_u or sigma_s is changed.
+        """
+        self.register_buffer('t_trans_exp', torch.exp(self.t_trans.detach()), persistent=False)
+        self.register_buffer('scaling_exp', torch.exp(self.scaling.detach()), persistent=False)
+        self.register_buffer('sigma_u_exp', torch.exp(self.sigma_u.detach()), persistent=False)
+        self.register_buffer('sigma_s_exp', torch.exp(self.sigma_s.detach()), persistent=False)
 
     def forward(self, t, y, neg_slope=0.0):
         return ode_br(t,
@@ -134,12 +165,10 @@ class decoder(nn.Module):
                       alpha=torch.exp(self.alpha),
                       beta=torch.exp(self.beta),
                       gamma=torch.exp(self.gamma),
-                      t_trans=torch.exp(self.t_trans),
+                      t_trans=self.t_trans_exp,
                       u0_root=torch.exp(self.u0_root),
                       s0_root=torch.exp(self.s0_root),
-                      sigma_u=torch.exp(self.sigma_u),
-                      sigma_s=torch.exp(self.sigma_s),
-                      scaling=torch.exp(self.scaling))
+                      scaling=self.scaling_exp)
 
     def pred_su(self, t, y, gidx=None):
         if gidx is None:
@@ -150,12 +179,10 @@ class decoder(nn.Module):
                           alpha=torch.exp(self.alpha),
                           beta=torch.exp(self.beta),
                           gamma=torch.exp(self.gamma),
-                          t_trans=torch.exp(self.t_trans),
+                          t_trans=self.t_trans_exp,
                           u0_root=torch.exp(self.u0_root),
                           s0_root=torch.exp(self.s0_root),
-                          sigma_u=torch.exp(self.sigma_u),
-                          sigma_s=torch.exp(self.sigma_s),
-                          scaling=torch.exp(self.scaling))
+                          scaling=self.scaling_exp)
         return ode_br(t,
                       y,
                       self.par,
@@ -163,12 +190,10 @@ class decoder(nn.Module):
                       alpha=torch.exp(self.alpha[:, gidx]),
                       beta=torch.exp(self.beta[:, gidx]),
                       gamma=torch.exp(self.gamma[:, gidx]),
-                      t_trans=torch.exp(self.t_trans),
+                      t_trans=self.t_trans_exp,
                       u0_root=torch.exp(self.u0_root[:, gidx]),
                       s0_root=torch.exp(self.s0_root[:, gidx]),
-                      sigma_u=torch.exp(self.sigma_u[gidx]),
-                      sigma_s=torch.exp(self.sigma_s[gidx]),
-                      scaling=torch.exp(self.scaling[gidx]))
+                      scaling=self.scaling_exp[gidx])
 
 
 class BrODE():
@@ -240,7 +265,8 @@ class BrODE():
             "early_stop_thred": adata.n_vars*1e-3,
             "train_test_split": 0.7,
             "weight_sample": False,
-            "sparsify": 1
+            "sparsify": 1,
+            "compile": False
         }
 
         self._set_device(device)
@@ -275,10 +301,12 @@ class BrODE():
             self.device = torch.device('cpu')
 
     def _split_train_test(self, N):
-        rand_perm = np.random.permutation(N)
         n_train = int(N*self.config["train_test_split"])
-        self.train_idx = rand_perm[:n_train]
-        self.test_idx = rand_perm[n_train:]
+        # pick the cells with the n_train smallest random keys; keeping the indices
+        # sorted makes the later row gathers from the AnnData layers sequential
+        rand_part = np.argpartition(np.random.rand(N), max(n_train-1, 0))
+        self.train_idx = np.sort(rand_part[:n_train])
+        self.test_idx = np.sort(rand_part[n_train:])
 
         return
 
@@ -341,30 +369,24 @@ class BrODE():
                   s,
                   uhat,
                   shat,
-                  sigma_u, sigma_s,
                   weight=None):
         # 1. u,s,uhat,shat: raw and predicted counts
-        # 2. sigma_u, sigma_s : standard deviation of the Gaussian likelihood (decoder)
-        # 3. weight: sample weight
-        clip_fn = nn.Hardtanh(-P_MAX, P_MAX)
-        neg_log_gaussian = 0.5*((uhat-u)/sigma_u).pow(2) \
-            + 0.5*((shat-s)/sigma_s).pow(2) \
-            + torch.log(sigma_u)+torch.log(sigma_s*2*np.pi)
-        neg_log_gaussian = clip_fn(neg_log_gaussian)
-        if weight is not None:
-            neg_log_gaussian = neg_log_gaussian*weight.view(-1, 1)
-
-        return torch.mean(torch.sum(neg_log_gaussian, 1))
+        # 2. weight: sample weight
+        # The standard deviations of the Gaussian likelihood are taken from the decoder.
+        return _ode_risk_fn(u, s, uhat, shat,
+                            self.decoder.sigma_u_exp, self.decoder.sigma_s_exp,
+                            self.decoder.sigma_u, self.decoder.sigma_s,
+                            weight)
 
     def _train_epoch(self,
-                     train_loader,
+                     train_data,
                      test_set,
                      optimizer):
         """Training in each epoch with early stopping.
 
         Args:
-            train_loader (:class:`torch.utils.data.DataLoader`):
-                Data loader of the input data.
+            train_data (tuple of :class:`torch.Tensor`):
+                Training data, cell type labels and cell time on the device.
             test_set (:class:`torch.utils.data.Dataset`):
                 Validation dataset
             optimizer (optimizer from :class:`torch.optim`):
@@ -377,7 +399,10 @@ class BrODE():
         self.set_mode('train')
         stop_training = False
 
-        for i, batch in enumerate(train_loader):
+        x_train, label_train, t_train = train_data
+        N, B = x_train.shape[0], self.config["batch_size"]
+        perm = torch.randperm(N, device=self.device)
+        for i in range(0, N, B):
             if self.counter == 1 or self.counter % self.config["test_iter"] == 0:
                 ll_test = self.test(test_set, self.counter)
                 if len(self.loss_test) > 0:
@@ -392,14 +417,13 @@ class BrODE():
                     break
 
             optimizer.zero_grad()
-            xbatch, label_batch, tbatch = batch[0].to(self.device), batch[1].to(self.device), batch[2].to(self.device)
+            idx = perm[i:i+B]
+            xbatch, label_batch, tbatch = x_train[idx], label_train[idx], t_train[idx]
             u, s = xbatch[:, :xbatch.shape[1]//2], xbatch[:, xbatch.shape[1]//2:]
 
             uhat, shat = self.forward(tbatch, label_batch.squeeze())
 
-            loss = self._ode_risk(u, s,
-                                  uhat, shat,
-                                  torch.exp(self.decoder.sigma_u), torch.exp(self.decoder.sigma_s))
+            loss = self._ode_risk(u, s, uhat, shat)
             loss.backward()
             # gradient clipping
             torch.nn.utils.clip_grad_value_(self.decoder.parameters(), GRAD_MAX)
@@ -439,18 +463,34 @@ class BrODE():
             w_df = pd.DataFrame(w_dic, index=pd.Index(cell_types))
             print(w_df)
 
-    def _update_std_noise(self, train_set):
-        G = train_set.G
-        Uhat, Shat, ll = self.pred_all(train_set.data,
-                                       torch.tensor(train_set.time).float().to(self.device),
-                                       train_set.labels,
-                                       np.array(range(G)))
-        self.decoder.sigma_u = nn.Parameter(torch.tensor(np.log((Uhat-train_set.data[:, :G]).std(0)+1e-16),
-                                            device=self.device))
-        self.decoder.sigma_s = nn.Parameter(torch.tensor(np.log((Shat-train_set.data[:, G:]).std(0)+1e-16),
-                                            device=self.device))
+    def _update_std_noise(self, train_data):
+        # reuse the training tensors already on the device and keep the predictions there
+        data, labels, t = train_data
+        G = data.shape[1]//2
+        Uhat, Shat, ll = self.pred_all(data,
+                                       t,
+                                       labels,
+                                       np.array(range(G)),
+                                       return_tensor=True)
+        # update in place so sigma_u and sigma_s stay registered with their original dtype
+        with torch.no_grad():
+            self.decoder.sigma_u.copy_(torch.log((Uhat-data[:, :G]).std(0, unbiased=False)+1e-16))
+            self.decoder.sigma_s.copy_(torch.log((Shat-data[:, G:]).std(0, unbiased=False)+1e-16))
+        self.decoder.refresh_const()
         return
 
+    def _compile_decoder(self):
+        """Compile the decoder forward pass with torch.compile (PyTorch 2.0+, GPU only).
+        Enabled by the 'compile' hyperparameter.
+        """
+        if not self.config["compile"] or hasattr(self.decoder, '_forward_raw'):
+            return
+        if self.device.type != 'cuda' or not hasattr(torch, 'compile'):
+            print('Warning: torch.compile requires PyTorch 2.0 and a GPU. Skipping compilation.')
+            return
+        self.decoder._forward_raw = self.decoder.forward
+        self.decoder.forward = torch.compile(self.decoder._forward_raw, dynamic=False)
+
     def _set_lr(self, p):
         """Set the learning rates based data sparsity.
 
@@ -491,6 +531,7 @@ class BrODE():
         self.tkey = tkey
         self.cluster_key = cluster_key
         self.load_config(config)
+        self._compile_decoder()
 
         if self.config["learning_rate"] is None:
             p = (np.sum(adata.layers["unspliced"].A > 0)
@@ -501,7 +542,7 @@ class BrODE():
         print("------------------------ Train a Branching ODE ------------------------")
         # Get data loader
         X = np.concatenate((adata.layers['Mu'], adata.layers['Ms']), 1)
-        X = X.astype(float)
+        X = X.astype(np.float32)
 
         cell_labels_raw = (adata.obs[cluster_key].to_numpy() if cluster_key in adata.obs else
                            np.array(['Unknown' for i in range(adata.n_obs)]))
@@ -513,7 +554,11 @@ class BrODE():
         test_set = None
         if len(self.test_idx) > 0:
             test_set = SCTimedData(X[self.test_idx], cell_labels[self.test_idx], t[self.test_idx])
-        data_loader = torch.utils.data.DataLoader(train_set, batch_size=self.config["batch_size"], shuffle=True)
+        # The training set is kept on the device and batches are drawn by index.
+        train_data = (torch.as_tensor(train_set.data, device=self.device),
+                      torch.as_tensor(train_set.labels, device=self.device),
+                      torch.as_tensor(train_set.time, dtype=torch.float32, device=self.device))
+        n_iter = (len(self.train_idx)+self.config["batch_size"]-1)//self.config["batch_size"]
         # Automatically set test iteration if not given
         if self.config["test_iter"] is None:
             self.config["test_iter"] = len(self.train_idx)//self.config["batch_size"]*2
@@ -531,19 +576,19 @@ class BrODE():
 
         # Main Training Process
         print("*********                    Start training                   *********")
-        print(f"Total Number of Iterations Per Epoch: {len(data_loader)}, test iteration: {self.config['test_iter']}")
+        print(f"Total Number of Iterations Per Epoch: {n_iter}, test iteration: {self.config['test_iter']}")
         n_epochs = self.config["n_epochs"]
         start = time.time()
 
-        sigma_u_prev = self.decoder.sigma_u.detach().cpu().numpy()
-        sigma_s_prev = self.decoder.sigma_s.detach().cpu().numpy()
+        sigma_u_prev = self.decoder.sigma_u.detach().cpu().numpy().copy()
+        sigma_s_prev = self.decoder.sigma_s.detach().cpu().numpy().copy()
         noise_change = np.inf
         count_epoch = 0
         for r in range(self.config['n_refine']):
             print(f"*********                        Round {r+1}                      *********")
             self.n_drop = 0
             for epoch in range(n_epochs):
-                stop_training = self._train_epoch(data_loader, test_set, optimizer)
+                stop_training = self._train_epoch(train_data, test_set, optimizer)
                 if plot and (epoch == 0 or (epoch+1) % self.config["save_epoch"] == 0):
                     ll_train = self.test(train_set,
                                          f"train{count_epoch+epoch+1}",
@@ -569,8 +614,8 @@ class BrODE():
                 sigma_s = self.decoder.sigma_s.detach().cpu().numpy()
                 norm_delta_sigma = np.sum((sigma_u-sigma_u_prev)**2 + (sigma_s-sigma_s_prev)**2)
                 norm_sigma = np.sum(sigma_u_prev**2 + sigma_s_prev**2)
-                sigma_u_prev = self.decoder.sigma_u.detach().cpu().numpy()
-                sigma_s_prev = self.decoder.sigma_s.detach().cpu().numpy()
+                sigma_u_prev = self.decoder.sigma_u.detach().cpu().numpy().copy()
+                sigma_s_prev = self.decoder.sigma_s.detach().cpu().numpy().copy()
                 noise_change = norm_delta_sigma/norm_sigma
                 print(f"Change in noise variance: {noise_change:.4f}")
             stop_training = noise_change < 0.01
@@ -578,7 +623,7 @@ class BrODE():
                 print(f"Training converged at round {r}")
                 break
             else:
-                self._update_std_noise(train_set)
+                self._update_std_noise(train_data)
         if plot:
             plot_train_loss(self.loss_train,
                             range(1, len(self.loss_train)+1),
@@ -592,55 +637,65 @@ class BrODE():
         print(f"*********              Finished. Total Time = {convert_time(self.timer)}             *********")
         return
 
-    def pred_all(self, data, t, cell_labels, gene_idx=None):
+    def pred_all(self, data, t, cell_labels, gene_idx=None, return_tensor=False):
         """Generate different types of predictions from the model for all cells.
 
         Args:
-            data (:class:`torch.Tensor`):
-                Input cell-by-gene tensor, with U and S concatenated at the gene dimension (dim=1).
+            data (:class:`torch.Tensor` or :class:`numpy.ndarray` or tuple):
+                Input cell-by-gene matrix, with U and S concatenated at the gene dimension (dim=1),
+                or a tuple of separate (U, S) matrices.
+                Tensors are sliced on their device; host arrays are moved to the device one batch at a time.
             cell_labels (:class:`torch.Tensor`):
                 Cell type annotations encoded in integers.
             gene_idx (array like, optional):
                 Indices of genes for subsetting.
                 If set to None, only the log likelihood will be computed. Defaults to None.
+            return_tensor (bool, optional):
+                Whether to return the predictions as tensors on the device instead of numpy arrays.
+                Defaults to False.
 
         Returns:
             tuple:
 
-                - :class:`torch.Tensor`: Predicted unspliced and spliced counts.
+                - :class:`numpy.ndarray` or :class:`torch.Tensor`: Predicted unspliced and spliced counts.
 
                 - float: ODE training/validation loss.
         """
-        N, G = data.shape
-        G = G//2
+        if isinstance(data, tuple):
+            N, G = data[0].shape
+        else:
+            N, G = data.shape
+            G = G//2
         if gene_idx is None:
             Uhat, Shat = None, None
+        elif return_tensor:
+            Uhat = torch.empty((N, len(gene_idx)), dtype=torch.float32, device=self.device)
+            Shat = torch.empty((N, len(gene_idx)), dtype=torch.float32, device=self.device)
         else:
-            Uhat, Shat = np.zeros((N, len(gene_idx))), np.zeros((N, len(gene_idx)))
+            Uhat = np.zeros((N, len(gene_idx)), dtype=np.float32)
+            Shat = np.zeros((N, len(gene_idx)), dtype=np.float32)
+        if isinstance(data, torch.Tensor):
+            data = data.to(device=self.device, dtype=torch.float32)
+        t = torch.as_tensor(t, dtype=torch.float32, device=self.device)
+        cell_labels = torch.as_tensor(cell_labels, device=self.device)
         ll = 0
         with torch.no_grad():
             B = min(N//5, 5000)
-            Nb = N // B
-            for i in range(Nb):
-                uhat, shat = self.eval_model(t[i*B:(i+1)*B], torch.tensor(cell_labels[i*B:(i+1)*B]).to(self.device))
-                if gene_idx is not None:
-                    Uhat[i*B:(i+1)*B] = uhat[:, gene_idx].cpu().numpy()
-                    Shat[i*B:(i+1)*B] = shat[:, gene_idx].cpu().numpy()
-                loss = self._ode_risk(torch.tensor(data[i*B:(i+1)*B, :G]).float().to(self.device),
-                                      torch.tensor(data[i*B:(i+1)*B, G:]).float().to(self.device),
-                                      uhat, shat,
-                                      torch.exp(self.decoder.sigma_u), torch.exp(self.decoder.sigma_s))
-                ll = ll - (B/N)*loss
-            if N > B*Nb:
-                uhat, shat = self.eval_model(t[B*Nb:], torch.tensor(cell_labels[B*Nb:]).to(self.device))
-                if gene_idx is not None:
-                    Uhat[Nb*B:] = uhat[:, gene_idx].cpu().numpy()
-                    Shat[Nb*B:] = shat[:, gene_idx].cpu().numpy()
-                loss = self._ode_risk(torch.tensor(data[B*Nb:, :G]).float().to(self.device),
-                                      torch.tensor(data[B*Nb:, G:]).float().to(self.device),
-                                      uhat, shat,
-                                      torch.exp(self.decoder.sigma_u), torch.exp(self.decoder.sigma_s))
-                ll = ll - ((N-B*Nb)/N)*loss
+            for i in range(0, N, B):
+                uhat, shat = self.eval_model(t[i:i+B], cell_labels[i:i+B])
+                if gene_idx is not None and return_tensor:
+                    Uhat[i:i+B] = uhat[:, gene_idx]
+                    Shat[i:i+B] = shat[:, gene_idx]
+                elif gene_idx is not None:
+                    Uhat[i:i+B] = uhat[:, gene_idx].cpu().numpy()
+                    Shat[i:i+B] = shat[:, gene_idx].cpu().numpy()
+                if isinstance(data, tuple):
+                    x = np.hstack((data[0][i:i+B], data[1][i:i+B]))
+                else:
+                    x = data[i:i+B]
+                x = torch.as_tensor(x, dtype=torch.float32, device=self.device)
+                loss = self._ode_risk(x[:, :G], x[:, G:], uhat, shat)
+                ll = ll - (uhat.shape[0]/N)*loss
         return Uhat, Shat, ll.cpu().item()
 
     def test(self,
@@ -654,11 +709,12 @@ class BrODE():
 
         self.set_mode('eval')
         Uhat, Shat, ll = self.pred_all(dataset.data,
-                                       torch.tensor(dataset.time).float().to(self.device),
+                                       torch.as_tensor(dataset.time, dtype=torch.float32, device=self.device),
                                        dataset.labels,
                                        gind)
-        cell_labels_raw = int2str(dataset.labels, self.decoder.label_dic_rev)
         if plot:
+            cell_labels_raw = int2str(dataset.labels, self.decoder.label_dic_rev)
+            t_trans = self.decoder.t_trans_exp.cpu().numpy()
             for i in range(len(gene_plot)):
                 idx = gind[i]
                 plot_sig(dataset.time.squeeze(),
@@ -668,7 +724,7 @@ class BrODE():
                          gene_plot[i],
                          save=f"{path}/sig-{gene_plot[i]}-{testid}.png",
                          sparsify=self.config["sparsify"],
-                         t_trans=self.decoder.t_trans.detach().cpu().exp().numpy())
+                         t_trans=t_trans)
 
         return ll
 
@@ -703,25 +759,35 @@ class BrODE():
         self.set_mode('eval')
         os.makedirs(file_path, exist_ok=True)
 
-        X = np.concatenate((adata.layers['Mu'], adata.layers['Ms']), 1)
         t = adata.obs[self.tkey].to_numpy()
         label_int = str2int(adata.obs[self.cluster_key].to_numpy(), self.decoder.label_dic)
 
         adata.obs[f"{key}_time"] = t
         adata.obs[f"{key}_label"] = label_int
-        adata.varm[f"{key}_alpha"] = np.exp(self.decoder.alpha.detach().cpu().numpy()).T
-        adata.varm[f"{key}_beta"] = np.exp(self.decoder.beta.detach().cpu().numpy()).T
-        adata.varm[f"{key}_gamma"] = np.exp(self.decoder.gamma.detach().cpu().numpy()).T
-        adata.uns[f"{key}_t_trans"] = np.exp(self.decoder.t_trans.detach().cpu().numpy())
-        adata.varm[f"{key}_u0_root"] = np.exp(self.decoder.u0_root.detach().cpu().numpy()).T
-        adata.varm[f"{key}_s0_root"] = np.exp(self.decoder.s0_root.detach().cpu().numpy()).T
-        adata.var[f"{key}_scaling"] = np.exp(self.decoder.scaling.detach().cpu().numpy())
-        adata.var[f"{key}_sigma_u"] = np.exp(self.decoder.sigma_u.detach().cpu().numpy())
-        adata.var[f"{key}_sigma_s"] = np.exp(self.decoder.sigma_s.detach().cpu().numpy())
+        # exponentiate all parameters on the device and copy them to the host in one transfer
+        params = [self.decoder.alpha, self.decoder.beta, self.decoder.gamma,
+                  self.decoder.t_trans, self.decoder.u0_root, self.decoder.s0_root,
+                  self.decoder.scaling, self.decoder.sigma_u, self.decoder.sigma_s]
+        with torch.no_grad():
+            params_flat = torch.exp(torch.cat([x.flatten() for x in params])).cpu().numpy()
+        split_idx = np.cumsum([x.numel() for x in params])[:-1]
+        (alpha, beta, gamma,
+         t_trans, u0_root, s0_root,
+         scaling, sigma_u, sigma_s) = [y.reshape(x.shape) for x, y in zip(params, np.split(params_flat, split_idx))]
+        adata.varm[f"{key}_alpha"] = alpha.T
+        adata.varm[f"{key}_beta"] = beta.T
+        adata.varm[f"{key}_gamma"] = gamma.T
+        adata.uns[f"{key}_t_trans"] = t_trans
+        adata.varm[f"{key}_u0_root"] = u0_root.T
+        adata.varm[f"{key}_s0_root"] = s0_root.T
+        adata.var[f"{key}_scaling"] = scaling
+        adata.var[f"{key}_sigma_u"] = sigma_u
+        adata.var[f"{key}_sigma_s"] = sigma_s
         adata.uns[f"{key}_w"] = self.decoder.w.detach().cpu().numpy()
 
-        Uhat, Shat, ll = self.pred_all(X,
-                                       torch.tensor(t.reshape(-1, 1)).to(self.device),
+        # pass the layers separately; pred_all only concatenates one batch at a time
+        Uhat, Shat, ll = self.pred_all((adata.layers['Mu'], adata.layers['Ms']),
+                                       t.reshape(-1, 1),
                                        label_int,
                                        np.array(range(adata.n_vars)))
         adata.layers[f"{key}_uhat"] = Uhat
@@ -1,6 +1,7 @@
 """Model utility functions
 """
 import numpy as np
+import pandas as pd
 import os
 import torch
 import torch.nn as nn
@@ -13,6 +14,7 @@ from tqdm.autonotebook import trange
 from sklearn.cluster import SpectralClustering, KMeans
 from scipy.stats import dirichlet, bernoulli, kstest, linregress
 from scipy.linalg import svdvals
+from scipy.sparse import csr_matrix
 
 ###################################################################################
 # Dynamical Model
@@ -852,7 +854,11 @@ def str2int(cell_labels_raw, label_dic):
         :class:`numpy.ndarray`:
             Integer encodings of cell type annotations.
     """
-    return np.array([label_dic[cell_labels_raw[i]] for i in range(len(cell_labels_raw))])
+    # hash-based lookup of all labels at once instead of one dict access per cell
+    codes = pd.Categorical(cell_labels_raw, categories=list(label_dic.keys())).codes
+    if np.any(codes < 0):
+        raise KeyError(f"Unknown cell type: {np.asarray(cell_labels_raw)[codes < 0][0]}")
+    return np.array(list(label_dic.values()))[codes]
 
 
 def int2str(cell_labels, label_dic_rev):
@@ -868,7 +874,48 @@ def int2str(cell_labels, label_dic_rev):
         :class:`numpy.ndarray`:
             Original cell type annotations.
     """
-    return np.array([label_dic_rev[cell_labels[i]] for i in range(len(cell_labels))])
+    keys = np.array(list(label_dic_rev.keys()))
+    values = np.array(list(label_dic_rev.values()))
+    lut = np.empty(keys.max()+1, dtype=values.dtype)
+    lut[keys] = values
+    return lut[np.asarray(cell_labels, dtype=int)]
+
+
+def group_quantile(x, labels, n_group, q):
+    """Compute a quantile of x within each group, sorting x only once.
+    Gives the same result as [np.quantile(x[labels == i], q) for i in range(n_group)]
+    when every group is non-empty.
+
+    Args:
+        x (:class:`numpy.ndarray`):
+            1D array of values, (N,)
+        labels (:class:`numpy.ndarray`):
+            Group of each value encoded in integers from 0 to n_group-1, (N,)
+        n_group (int):
+            Number of groups
+        q (float):
+            Quantile between 0 and 1
+
+    Returns:
+        :class:`numpy.ndarray`:
+            Quantile of each group, (n_group,).
+
+    Raises:
+        ValueError: If any group has no values.
+    """
+    count = np.bincount(labels, minlength=n_group)
+    if np.any(count == 0):
+        raise ValueError(f"No values in group(s) {np.where(count == 0)[0].tolist()}")
+    x_sorted = x[np.lexsort((x, labels))]
+    start = np.cumsum(count) - count
+    # linear interpolation between order statistics, as in np.quantile
+    pos = q*(count-1)
+    lo = np.floor(pos).astype(int)
+    hi = np.minimum(lo+1, count-1)
+    x_lo = x_sorted[start+lo]
+    x_hi = x_sorted[start+hi]
+    out = x_lo + (x_hi-x_lo)*(pos-lo)
+    return out
 
 
 def linreg_mtx(u, s):
@@ -1340,48 +1387,36 @@ def knn_transition_prob(t,
     # Used in transition graph construction.
     ############################################################
     N, Nq = len(t), len(t_query)
-    P = np.zeros((n_type, n_type))
-    t0 = np.zeros((n_type))
-    sigma_t = np.zeros((n_type))
-
-    for i in range(n_type):
-        t0[i] = np.quantile(t[cell_labels == i], 0.01)
-        sigma_t[i] = t[cell_labels == i].std()
+    # Sort the cells by time once so that each window is a contiguous slice
+    t_order = np.argsort(t, kind='stable')
+    t_sorted = t[t_order]
+    win_lb = np.searchsorted(t_sorted, t_query - dt[1], side='left')
+    win_ub = np.searchsorted(t_sorted, t_query - dt[0], side='left')
+    onehot = csr_matrix((np.ones(N), (np.arange(N), cell_labels)), shape=(N, n_type))
     if soft_assign:
-        A = np.empty((N, N))
+        rows, cols = [], []
         for i in range(Nq):
-            t_ub, t_lb = t_query[i] - dt[0], t_query[i] - dt[1]
-            indices = np.where((t >= t_lb) & (t < t_ub))[0]
-            k_ = len(indices)
-            if k_ > 0:
-                if k_ <= k:
-                    A[i, indices] = 1
-                else:
-                    knn_model = NearestNeighbors(n_neighbors=k)
-                    knn_model.fit(z[indices])
-                    dist, ind = knn_model.kneighbors(z_query[i:i+1])
-                    A[i, indices[ind.squeeze()]] = 1
-        for i in range(n_type):
-            for j in range(n_type):
-                P[i, j] = A[cell_labels == i][:, cell_labels == j].sum()
+            indices = t_order[win_lb[i]:win_ub[i]]
+            if len(indices) > k:
+                # exact k nearest neighbors in the window
+                dist = ((z[indices] - z_query[i])**2).sum(1)
+                indices = indices[np.argpartition(dist, k-1)[:k]]
+            rows.append(np.full(len(indices), i))
+            cols.append(indices)
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        A = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(N, N))
+        # sum A over all pairs of cell types at once with a one-hot encoding
+        P = (onehot.T @ A @ onehot).toarray()
     else:
-        A = np.empty((N, n_type))
+        rows, cols = [], []
         for i in range(Nq):
-            t_ub, t_lb = t_query[i] - dt[0], t_query[i] - dt[1]
-            indices = np.where((t >= t_lb) & (t < t_ub))[0]
-            k_ = len(indices)
-            if k_ > 0:
-                if k_ <= k:
-                    knn_model = NearestNeighbors(n_neighbors=min(k, k_))
-                    knn_model.fit(z[indices])
-                    dist, ind = knn_model.kneighbors(z_query[i:i+1])
-                    knn_label = cell_labels[indices][ind.squeeze()]
-                else:
-                    knn_label = cell_labels[indices]
-                n_par = np.array([np.sum(knn_label == i) for i in range(n_type)])
-                A[i, np.argmax(n_par)] = 1
-        for i in range(n_type):
-            P[i] = A[cell_labels == i].sum(0)
+            indices = t_order[win_lb[i]:win_ub[i]]
+            if len(indices) > 0:
+                n_par = np.bincount(cell_labels[indices], minlength=n_type)
+                rows.append(i)
+                cols.append(np.argmax(n_par))
+        A = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(N, n_type))
+        P = (onehot.T @ A).toarray()
     psum = P.sum(1)
     psum[psum == 0] = 1
     return P/(psum.reshape(-1, 1))
@@ -1458,12 +1493,18 @@ def convert_time(t):
 def sample_genes(adata, n, key, mode='top', q=0.5):
     if mode == 'random':
         return np.random.choice(adata.var_names, n, replace=False)
-    val_sorted = adata.var[key].sort_values(ascending=False)
-    genes_sorted = val_sorted.index.to_numpy()
     if mode == 'quantile':
+        val_sorted = adata.var[key].sort_values(ascending=False)
+        genes_sorted = val_sorted.index.to_numpy()
         N = np.sum(val_sorted.to_numpy() >= q)
         return np.random.choice(genes_sorted[:N], min(n, N), replace=False)
-    return genes_sorted[:n]
+    # Partial sort: only the top n genes need to be ordered
+    val = adata.var[key].to_numpy(dtype=float)
+    val = np.where(np.isnan(val), -np.inf, val)
+    n = min(n, len(val))
+    idx = np.argpartition(-val, n-1)[:n] if 0 < n < len(val) else np.arange(len(val))[:n]
+    idx = idx[np.argsort(-val[idx], kind='stable')]
+    return adata.var_names.to_numpy()[idx]
 
 
 def add_capture_time(adata, tkey, save_key="tprior"):
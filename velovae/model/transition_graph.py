@@ -5,9 +5,9 @@ It is a directed graph with cell types as vertices and
 edges represent progenitor-descendant relations.
 """
 import numpy as np
-from copy import deepcopy
+from collections import deque
 import scanpy as sc
-from .model_util import knn_transition_prob
+from .model_util import knn_transition_prob, group_quantile
 from ..analysis.evaluation_util import calibrated_cross_boundary_correctness
 
 #######################################################################
@@ -58,104 +58,35 @@ def decode_graph(graph, init_types, label_dic_rev):
     return graph_dec, init_types_dec
 
 
-def str2int(cell_labels_raw, label_dic):
-    return np.array([label_dic[cell_labels_raw[i]] for i in range(len(cell_labels_raw))])
-
-
-def int2str(cell_labels, label_dic_rev):
-    return np.array([label_dic_rev[cell_labels[i]] for i in range(len(cell_labels))])
-
-
-def recover_transition_time_rec(t_trans, ts, prev_type, graph):
-    #######################################################################
-    # Applied to the branching ODE
-    # Recursive helper function of recovering transition time.
-    #######################################################################
-
-    if len(graph[prev_type]) == 0:
-        return
-    for cur_type in graph[prev_type]:
-        t_trans[cur_type] += t_trans[prev_type]
-        ts[cur_type] += t_trans[cur_type]
-        recover_transition_time_rec(t_trans, ts, cur_type, graph)
-    return
-
-
 def recoverTransitionTime(t_trans, ts, graph, init_type):
     #######################################################################
     # Applied to the branching ODE
     # Recovers the transition and switching time from the relative time.
     #######################################################################
 
-    t_trans_orig = deepcopy(t_trans)
-    ts_orig = deepcopy(ts)
+    t_trans_orig = t_trans.copy()
+    ts_orig = ts.copy()
+    # Depth-first traversal with an explicit stack; parents are always updated before children
+    stack = deque()
     for x in init_type:
         ts_orig[x] += t_trans_orig[x]
-        recover_transition_time_rec(t_trans_orig, ts_orig, x, graph)
+        stack.append(x)
+    while len(stack) > 0:
+        prev_type = stack.pop()
+        for cur_type in graph[prev_type]:
+            t_trans_orig[cur_type] += t_trans_orig[prev_type]
+            ts_orig[cur_type] += t_trans_orig[cur_type]
+            stack.append(cur_type)
     return t_trans_orig, ts_orig
 
 
-def merge_nodes(graph, parents, n_nodes, loop, v_outside):
-    #######################################################################
-    # Merge nodes into a super-node and change the graph accordingly
-    #######################################################################
-
-    # Create a new map from
-    v_map = {}
-    v_to_loop = {}  # maps any vertex outside the loop to the vertex in the loop with the maximum weight
-    loop_to_v = {}
-    i_new = 0
-    for i in range(n_nodes):  # reassign a vertice id to all vertices not in the loop
-        if i not in loop:
-            v_map[i] = i_new
-            i_new = i_new + 1
-    for i in loop:  # assign the same vertice id for all vertices in the super-node
-        v_map[i] = i_new
-
-    weight_to_loop = {}
-    weight_from_loop = {}
-    for x in loop:
-        for y in v_outside:
-            if not np.isinf(graph[x, y]):  # edge to the loop
-                if y not in v_to_loop:
-                    v_to_loop[y] = x
-                    weight_to_loop[y] = graph[x, y] - graph[x, parents[x]]
-                elif graph[x, y] - graph[x, parents[x]] > weight_to_loop[y]:
-                    v_to_loop[y] = x
-                    weight_to_loop[y] = graph[x, y] - graph[x, parents[x]]
-            if not np.isinf(graph[y, x]):  # edge from the loop
-                if y not in loop_to_v:
-                    loop_to_v[y] = x
-                    weight_from_loop[y] = graph[y, x]
-                elif graph[y, x] > weight_from_loop[y]:
-                    loop_to_v[y] = x
-                    weight_from_loop[y] = graph[y, x]
-
-    graph_new = np.ones((n_nodes-len(loop)+1, n_nodes-len(loop)+1)) * (-np.inf)
-    vc = v_map[loop[0]]
-    for x in v_outside:
-        for y in v_outside:
-            graph_new[v_map[x], v_map[y]] = graph[x, y]
-    # assign edge weights to the new graph with the super-node
-    for x in v_outside:
-        if x in v_to_loop:
-            graph_new[vc, v_map[x]] = weight_to_loop[x]
-        if x in loop_to_v:
-            graph_new[v_map[x], vc] = weight_from_loop[x]
-
-    return v_map, v_to_loop, loop_to_v, graph_new
-
-
 def adj_matrix_to_list(A):
     n_type = A.shape[0]
-    adj_list = {}
-    for i in range(n_type):
-        adj_list[i] = []
-    for i in range(n_type):
-        idx_noninf = np.where(~(np.isinf(A[i])))[0]
-        for par in idx_noninf:
-            adj_list[par].append(i)
-    return adj_list
+    # A[i, j] is the edge from j to i; group the children by parent with a stable sort
+    child, par = np.nonzero(~np.isinf(A))
+    order = np.argsort(par, kind='stable')
+    children = np.split(child[order], np.searchsorted(par[order], np.arange(1, n_type)))
+    return {i: children[i].tolist() for i in range(n_type)}
 
 
 def check_connected(adj_list, root, n_nodes):
@@ -163,157 +94,122 @@ def check_connected(adj_list, root, n_nodes):
     # Check if a directed graph is connected
     #######################################################################
 
-    checked = np.array([False for i in range(n_nodes)])
+    checked = bytearray(n_nodes)
 
-    queue = [root]
-    checked[root] = True
+    queue = deque([root])
+    checked[root] = 1
     while len(queue) > 0:
-        ptr = queue.pop(0)
+        ptr = queue.popleft()
         for child in adj_list[ptr]:
             if not checked[child]:
                 queue.append(child)
-                checked[child] = True
-
-    return np.all(checked)
-
-
-def get_loop(trace_back, n_nodes, start):
-    #######################################################################
-    # trace_back is a dictionary mapping each node to its antecedent
-    #######################################################################
+                checked[child] = 1
 
-    loop = []
-    v_outside = []
-    ptr = start
-    try:
-        while not trace_back[ptr] == start:
-            loop.append(trace_back[ptr])
-            ptr = trace_back[ptr]
-        loop.append(start)
-    except KeyError:
-        print("Key Error.")
-        print(trace_back)
-
-    for i in range(n_nodes):
-        if i not in loop:
-            v_outside.append(i)
-    return np.flip(loop), v_outside
-
-
-def check_loop(adj_list, n_nodes):
-    #######################################################################
-    # Check whether a loop exists in a graph
-    # Applies BFS
-    #######################################################################
-    loop = []
-
-    for node in range(n_nodes):
-        checked = np.array([False for i in range(n_nodes)])
-        queue = [node]
-        trace_back = {}
-        while len(queue) > 0:
-            ptr = queue.pop(0)
-            if checked[ptr]:  # the node has been visited, meaning a cycle
-                loop, v_outside = get_loop(trace_back, n_nodes, ptr)
-                if len(loop) == 1:
-                    break
-                return loop, v_outside
-            else:
-                checked[ptr] = True
-            for child in adj_list[ptr]:  # push all child nodes to the queue
-                trace_back[child] = ptr
-                queue.append(child)
-
-    return np.array([]), np.array(range(n_nodes))
+    return all(checked)
 
 
 def edmond_chu_liu(graph, r):
-    """Find a minimum spanning tree in a directed graph.
+    """Find a maximum spanning tree (arborescence) in a directed graph.
+    Cycles of best incident edges are contracted iteratively and expanded in reverse order.
 
     Args:
         graph (:class:`numpy.ndarray`):
             A 2-d array representing an adjacency matrix, (num type x num type).
             Notice that graph[i,j] is the edge from j to i.
+            A missing edge has a weight of -inf.
+            A self-loop graph[i,i] allows node i to start a separate tree.
         r (int):
             Root node.
 
     Returns:
         :class:`numpy.ndarray`:
-            Minimum spanning tree in the form of an adjacency matrix.
+            Maximum spanning tree in the form of an adjacency matrix.
+            Roots (r and nodes that start a separate tree) point to themselves.
     """
-    #######################################################################
-    # graph: a 2-d array representing an adjacency matrix
-    # Notice that graph[i,j] is the edge from j to i
-    #######################################################################
-
     n_type = graph.shape[0]
-    # step 1: remove any edge to the root
-    graph[r] = -np.inf
-
-    # step 2: find the best incident edge to each node except for r
-    adj_list_pruned = {}
-
-    parents = []
-    for i in range(n_type):  # iterate through all vertices
-        idx_noninf = np.where(~(np.isinf(graph[i])))[0]  # filter out vertices with edges
-        if len(idx_noninf) > 0:
-            max_val = np.max(graph[i][idx_noninf])
-            parents.append(np.where(graph[i] == max_val)[0][0])
-        else:
-            parents.append((i+np.random.choice(n_type)) % n_type)
-    parents = np.array(parents)
-
-    for i in range(n_type):
-        adj_list_pruned[i] = []
-    for i in range(n_type):
-        if not i == r:
-            adj_list_pruned[parents[i]].append(i)
+    root = n_type  # virtual root, parent of r and of the self-looped nodes
+
+    # step 1: build the edge list, removing any edge to the root
+    dst, src = np.nonzero(~np.isinf(graph))
+    keep = (dst != r) & (src != dst)
+    src, dst = src[keep], dst[keep]
+    w = graph[dst, src].astype(float)
+    # Edges from the virtual root carry the self-loop weights.
+    # Nodes without a self-loop get a weight low enough to be used only
+    # when the node is unreachable from r.
+    w_finite = graph[~np.isinf(graph)]
+    w_low = (w_finite.min() - (n_type+1)*(w_finite.max()-w_finite.min()) - 1.0
+             if len(w_finite) > 0 else -1.0)
+    w_root = np.diag(graph).astype(float)
+    w_root[np.isinf(w_root)] = w_low
+    w_root[r] = 0.0
+    src = np.concatenate((src, np.full(n_type, root)))
+    dst = np.concatenate((dst, np.arange(n_type)))
+    w = np.concatenate((w, w_root))
+    # ties are broken by the smallest parent index, a self-loop counting as the node itself
+    order = np.lexsort((np.where(src == root, dst, src), dst))
+    src, dst, w = src[order], dst[order], w[order]
+
+    # step 2: contract cycles until the best incident edges form a tree
+    n_cur, root_cur = n_type+1, root
+    src_cur, dst_cur, w_cur = src, dst, w
+    levels = []
+    while True:
+        # best incident edge to each node except for the root
+        # (the first edge with the maximum weight, so that ties follow the edge order)
+        w_max = np.full(n_cur, -np.inf)
+        np.maximum.at(w_max, dst_cur, w_cur)
+        is_max = np.nonzero(w_cur == w_max[dst_cur])[0]
+        best = np.full(n_cur, len(w_cur))
+        np.minimum.at(best, dst_cur[is_max], is_max)
+        best[best == len(w_cur)] = -1
+        par = src_cur[best]
+
+        # cycle detection: follow the parents from each node until reaching
+        # the root, a known cycle, or a node already visited from this start
+        cycle = np.full(n_cur, -1)
+        visit = np.full(n_cur, -1)
+        n_cycle = 0
+        for v in range(n_cur):
+            u = v
+            while u != root_cur and visit[u] != v and cycle[u] < 0:
+                visit[u] = v
+                u = par[u]
+            if u != root_cur and cycle[u] < 0:
+                x = u
+                while True:
+                    cycle[x] = n_cycle
+                    x = par[x]
+                    if x == u:
+                        break
+                n_cycle += 1
+        if n_cycle == 0:
+            break
+
+        # merge each cycle into a super-node and reduce the weights of edges into it
+        node_map = cycle.copy()
+        outside = cycle < 0
+        node_map[outside] = n_cycle + np.arange(np.sum(outside))
+        w_new = w_cur - np.where(cycle[dst_cur] >= 0, w_cur[best[dst_cur]], 0.0)
+        src_new, dst_new = node_map[src_cur], node_map[dst_cur]
+        keep = np.nonzero(src_new != dst_new)[0]
+        levels.append((dst_cur, best, cycle, keep))
+        src_cur, dst_cur, w_cur = src_new[keep], dst_new[keep], w_new[keep]
+        n_cur, root_cur = n_cycle + np.sum(outside), node_map[root_cur]
+
+    # step 3: expand the super-nodes in reverse order
+    # Each cycle keeps all its edges except the one into the node entered from outside.
+    chosen = best[np.arange(n_cur) != root_cur]
+    for dst_l, best_l, cycle_l, keep_l in reversed(levels):
+        chosen = keep_l[chosen]
+        entered = np.zeros(len(cycle_l), dtype=bool)
+        entered[dst_l[chosen]] = True
+        chosen = np.concatenate((chosen, best_l[(cycle_l >= 0) & ~entered]))
 
-    # step 3: cycle detection using BFS
-    loop, v_outside = check_loop(adj_list_pruned, n_type)
-
-    # step 4: recursive call
     mst = np.zeros((n_type, n_type))
-    if len(loop) > 0:
-        # Merge all vertices in the loop into a super-node
-        # Incident edges to all vertices will be combined (taking the union)
-        v_map, v_to_loop, loop_to_v, graph_merged = merge_nodes(graph, parents, n_type, loop, v_outside)
-
-        vc = v_map[loop[0]]
-        mst_merged = edmond_chu_liu(graph_merged, v_map[r])  # adjacency matrix
-
-        # edges outside the loop
-        for x in v_outside:
-            for y in v_outside:
-                mst[x, y] = mst_merged[v_map[x], v_map[y]]
-
-        # edges within the loop
-        for i in range(len(loop)-1):
-            mst[loop[i+1], loop[i]] = 1
-        mst[loop[0], loop[-1]] = 1
-
-        # edges from the loop
-        for x in v_outside:
-            if mst_merged[v_map[x], vc] > 0:
-                mst[x, loop_to_v[x]] = mst_merged[v_map[x], vc]
-
-        # There's exactly one edge to the loop
-        source_to_loop = np.where(mst_merged[vc] > 0)[0][0]  # node in the merged mst
-        for x in v_outside:
-            if v_map[x] == source_to_loop:
-                source_to_loop = x
-                break
-        target_in_loop = v_to_loop[source_to_loop]
-        mst[target_in_loop, source_to_loop] = 1
-        # break the loop
-        idx_in_loop = np.where(loop == target_in_loop)[0][0]
-        mst[target_in_loop, loop[(idx_in_loop-1) % len(loop)]] = 0
-    else:
-        for i in range(n_type):
-            if i == r:
-                mst[i, i] = 1
-            else:
-                mst[i, parents[i]] = 1
+    is_root = src[chosen] == root
+    mst[dst[chosen][~is_root], src[chosen][~is_root]] = 1
+    mst[dst[chosen][is_root], dst[chosen][is_root]] = 1
     return mst
 #######################################################################
 # Transition Graph
@@ -357,12 +253,12 @@ class TransGraph():
         cell_labels_raw = (adata.obs[cluster_key].to_numpy()
                            if train_idx is None else
                            adata.obs[cluster_key][train_idx].to_numpy())
-        cell_types_raw = np.unique(cell_labels_raw)
+        # encode_type enumerates the sorted unique types, so the inverse indices are the labels
+        cell_types_raw, self.cell_labels = np.unique(cell_labels_raw, return_inverse=True)
         self.label_dic, self.label_dic_rev = encode_type(cell_types_raw)
 
         self.n_type = len(cell_types_raw)
-        self.cell_labels = np.array([self.label_dic[x] for x in cell_labels_raw])
-        self.cell_types = np.array([self.label_dic[cell_types_raw[i]] for i in range(self.n_type)])
+        self.cell_types = np.arange(self.n_type)
         self.t = adata.obs[tkey].to_numpy() if train_idx is None else adata.obs[tkey][train_idx].to_numpy()
         self.z = adata.obsm[embed_key] if train_idx is None else adata.obsm[embed_key][train_idx]
         self.use_vel_graph = vkey is not None
@@ -402,13 +298,11 @@ class TransGraph():
         partition_labels = (adata.obs["partition"].to_numpy()
                             if train_idx is None else
                             adata.obs["partition"][train_idx].to_numpy())
-        lineages = np.unique(partition_labels)
+        lineages, lineage_labels = np.unique(partition_labels, return_inverse=True)
         self.n_lineage = len(lineages)
+        # number of cells of each type in each partition, in a single pass over the cells
         count = np.zeros((self.n_type, self.n_lineage))
-
-        for i in (self.cell_types):
-            for j, lin in enumerate(lineages):
-                count[i, j] = np.sum((self.cell_labels == i) & (partition_labels == lin))
+        np.add.at(count, (self.cell_labels, lineage_labels), 1)
         self.partition = np.argmax(count, 1)
         self.partition_cluster = np.unique(self.partition)
         self.n_lineage = len(self.partition_cluster)
@@ -444,9 +338,37 @@ class TransGraph():
 
     def _get_init_time(self):
         # Estimate initial time
-        self.t_init = np.zeros((self.n_type))
-        for i in (self.cell_types):
-            self.t_init[i] = np.quantile(self.t[self.cell_labels == i], 0.05)
+        self.t_init = group_quantile(self.t, self.cell_labels, self.n_type, 0.05)
+
+    def _prune_graph(self, P_raw, n_par):
+        """Keep the n_par most likely parents of each cell type.
+        A parent can be any other cell type that does not start later.
+
+        Args:
+            P_raw (:class:`numpy.ndarray`):
+                Raw transition weight matrix, (num type x num type).
+            n_par (int):
+                Number of possible parent cell type candidates.
+
+        Returns:
+            :class:`numpy.ndarray`:
+                Pruned and row-normalized transition weight matrix.
+        """
+        t_init = self.t_init
+        candidate = (t_init.reshape(1, -1) <= t_init.reshape(-1, 1)) & ~np.eye(self.n_type, dtype=bool)
+        score = np.where(candidate, P_raw, -np.inf)
+        n_par = min(n_par, self.n_type)
+        top = np.argpartition(-score, n_par-1, axis=1)[:, :n_par]
+        top_score = np.take_along_axis(score, top, 1)
+        P = np.zeros(P_raw.shape)
+        np.put_along_axis(P, top, np.where(np.isinf(top_score), 0, top_score), 1)
+        # Prevents disconnected parts in the same partition
+        P += 1e-3*(t_init.reshape(1, -1) < t_init.reshape(-1, 1))
+
+        psum = P.sum(1, keepdims=True)
+        psum[psum == 0] = 1
+        P /= psum
+        return P
 
     def _time_based_graph(self,
                           n_par=2,
@@ -485,26 +407,8 @@ class TransGraph():
                                     k,
                                     soft_assign)
 
-        psum = P_raw.sum(1)
-        P_raw = P_raw/psum.reshape(-1, 1)
-        P = np.zeros(P_raw.shape)
-        for i in range(P.shape[0]):
-            idx_sort = np.flip(np.argsort(P_raw[i]))
-            count = 0
-            for j in range(P.shape[1]):
-                if (not idx_sort[j] == i) and (self.t_init[idx_sort[j]] <= self.t_init[i]):
-                    P[i, idx_sort[j]] = P_raw[i, idx_sort[j]]
-                    count = count + 1
-                if count == n_par:
-                    break
-            assert P[i, i] == 0
-            for j in range(P.shape[1]):  # Prevents disconnected parts in the same partition
-                if self.t_init[j] < self.t_init[i]:
-                    P[i, j] += 1e-3
-
-        psum = P.sum(1)
-        psum[psum == 0] = 1
-        P = P/psum.reshape(-1, 1)
+        # P_raw is already row-normalized by knn_transition_prob
+        P = self._prune_graph(P_raw, n_par)
 
         self.w = P
         return P_raw
@@ -532,24 +436,7 @@ class TransGraph():
                 P_raw[i, j] = (1-self.tscore[key])*(-self.cbdir[key])
             else:
                 P_raw[i, j] = self.tscore[key]*np.clip(self.cbdir[key], 1e-16, None)
-        P = np.zeros(P_raw.shape)
-        for i in range(P.shape[0]):
-            idx_sort = np.flip(np.argsort(P_raw[i]))
-            count = 0
-            for j in range(P.shape[1]):
-                if (not idx_sort[j] == i) and (self.t_init[idx_sort[j]] <= self.t_init[i]):
-                    P[i, idx_sort[j]] = P_raw[i, idx_sort[j]]
-                    count = count + 1
-                if count == n_par:
-                    break
-            assert P[i, i] == 0
-            for j in range(P.shape[1]):  # Prevents disconnected parts in the same partition
-                if self.t_init[j] < self.t_init[i]:
-                    P[i, j] += 1e-3
-
-        psum = P.sum(1)
-        psum[psum == 0] = 1
-        P = P/psum.reshape(-1, 1)
+        P = self._prune_graph(P_raw, n_par)
 
         self.w = P  # pruned graph
         return P_raw
@@ -593,12 +480,13 @@ class TransGraph():
         # For each partition, get the MST
         print("Obtaining the MST in each partition")
         out = np.zeros((self.n_type, self.n_type))
+        # log-weights of the pruned graph, computed once for all partitions
+        logw = np.log(self.w+1e-10)
+        logw[self.w == 0] = -np.inf
 
         for lineage in self.partition_cluster:
             vs_part = np.where(self.partition == lineage)[0]
-            mask = (self.w[vs_part][:, vs_part] == 0)
-            graph_part = np.log(self.w[vs_part][:, vs_part]+1e-10)
-            graph_part[mask] = -np.inf
+            graph_part = logw[np.ix_(vs_part, vs_part)]
             root = vs_part[np.argmin(self.t_init[vs_part])]
             root = np.where(vs_part == root)[0][0]
             graph_part[root, root] = 1.0
@@ -623,7 +511,5 @@ class TransGraph():
 
                 mst_part = edmond_chu_liu(graph_part, root)
 
-            for i, x in enumerate(vs_part):
-                for j, y in enumerate(vs_part):
-                    out[x, y] = mst_part[i, j]
+            out[np.ix_(vs_part, vs_part)] = mst_part
         return out
@@ -1,7 +1,6 @@
 import scanpy
 import numpy as np
 from .scvelo_preprocessing import *
-from tqdm import tqdm
 
 
 def count_peak_expression(adata, cluster_key="clusters"):
@@ -98,12 +97,10 @@ def balanced_gene_selection(adata, n_gene, cluster_key):
 
 
 def filt_gene_sparsity(adata, thred_u=0.99, thred_s=0.99):
-    N, G = adata.n_obs, adata.n_vars
-    sparsity_u = np.zeros((G))
-    sparsity_s = np.zeros((G))
-    for i in tqdm(range(G)):
-        sparsity_u[i] = np.sum(adata.layers["unspliced"][:, i].A.squeeze() == 0)/N
-        sparsity_s[i] = np.sum(adata.layers["spliced"][:, i].A.squeeze() == 0)/N
+    N = adata.n_obs
+    # count nonzeros of all genes at once instead of densifying one column at a time
+    sparsity_u = 1 - np.asarray((adata.layers["unspliced"] != 0).sum(0)).ravel()/N
+    sparsity_s = 1 - np.asarray((adata.layers["spliced"] != 0).sum(0)).ravel()/N
     gene_subset = (sparsity_u < thred_u) & (sparsity_s < thred_s)
     print(f"Kept {np.sum(gene_subset)} genes after sparsity filtering")
     adata._inplace_subset_var(gene_subset)
@@ -187,6 +184,8 @@ def preprocess(adata,
                compute_umap=False,
                umap_min_dist=0.5,
                keep_raw=True,
+               umap_gpu=False,
+               knn_method="umap",
                **kwargs):
     """Run the entire preprocessing pipeline using scanpy
 
@@ -248,6 +247,15 @@ def preprocess(adata,
         keep_raw (bool, optional):
             Whether to keep the original raw counts (without normalization).
             Defaults to True.
+        umap_gpu (bool, optional):
+            Whether to compute UMAP on GPU with rapids-singlecell.
+            Falls back to scanpy if rapids-singlecell is not installed.
+            Defaults to False.
+        knn_method (str, optional):
+            {'umap', 'hnsw', 'sklearn'}.
+            Method to build the KNN graph used by both moments and UMAP.
+            'hnsw' uses approximate search from hnswlib and is the fastest on large datasets.
+            Defaults to "umap".
     """
     # Preprocessing
     # 1. Cell, Gene filtering and data normalization
@@ -337,7 +345,7 @@ def preprocess(adata,
 
     # 2. KNN Averaging
     # remove_duplicate_cells(adata)
-    moments(adata, n_pcs=npc, n_neighbors=n_neighbors)
+    moments(adata, n_pcs=npc, n_neighbors=n_neighbors, method=knn_method)
 
     if keep_raw:
         print("Keep raw unspliced/spliced count data.")
@@ -363,4 +371,13 @@ def preprocess(adata,
         print("Computing UMAP coordinates.")
         if "X_umap" in adata.obsm:
             print("Warning: Overwriting existing UMAP coordinates.")
-        scanpy.tl.umap(adata, min_dist=umap_min_dist)
+        if umap_gpu:
+            try:
+                import rapids_singlecell as rsc
+            except ImportError:
+                print("Warning: rapids-singlecell not found. Using scanpy UMAP instead.")
+                umap_gpu = False
+        if umap_gpu:
+            rsc.tl.umap(adata, min_dist=umap_min_dist)
+        else:
+            scanpy.tl.umap(adata, min_dist=umap_min_dist)
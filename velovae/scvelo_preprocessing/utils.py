@@ -286,7 +286,7 @@ def filter_genes(
                 (Xs > 0).multiply(Xu > 0) if issparse(Xs) else (Xs > 0) * (Xu > 0)
             )
             X = (
-                nonzeros.multiply(Xs) + nonzeros.multiply(Xu)
+                nonzeros.multiply(Xs + Xu)
                 if issparse(nonzeros)
                 else nonzeros * (Xs + Xu)
             )
@@ -405,6 +405,8 @@ def filter_genes_dispersion(
         - in this case you should set `log` to `False`. In their default
         workflows, Seurat passes the cutoffs whereas Cell Ranger passes
         `n_top_genes`.
+        'seurat_v3' ranks genes by the variance of standardized raw counts and
+        expects unnormalized counts in `.X`. It requires `n_top_genes`.
     min_mean=0.0125, max_mean=3, min_disp=0.5, max_disp=`None` : `float`, optional
         If `n_top_genes` unequals `None`, these cutoffs for the means and the
         normalized dispersions are ignored.
@@ -434,7 +436,8 @@ def filter_genes_dispersion(
     adata = data.copy() if copy else data
     set_initial_size(adata)
 
-    mean, var = materialize_as_ndarray(get_mean_var(adata.X))
+    if flavor != "seurat_v3":
+        mean, var = materialize_as_ndarray(get_mean_var(adata.X))
 
     if n_top_genes is not None and adata.n_vars < n_top_genes:
         logg.info(
@@ -442,7 +445,15 @@ def filter_genes_dispersion(
             "of variables are less than `n_top_genes`."
         )
     else:
-        if flavor == "svr":
+        if flavor == "seurat_v3":
+            from scanpy.preprocessing import highly_variable_genes
+
+            # operates on raw counts and keeps sparse input sparse
+            highly_variable_genes(
+                adata, n_top_genes=n_top_genes, flavor="seurat_v3", subset=False
+            )
+
+        elif flavor == "svr":
             from sklearn.svm import SVR
 
             log_mu = np.log2(mean)
@@ -508,7 +519,9 @@ def filter_genes_dispersion(
                 std = disp_mad_bin[df["mean_bin"].values].values
                 df["dispersion_norm"] = np.abs(val - mu) / std
             else:
-                raise ValueError('`flavor` needs to be "seurat" or "cell_ranger"')
+                raise ValueError(
+                    '`flavor` needs to be "seurat", "seurat_v3", "cell_ranger" or "svr"'
+                )
             dispersion_norm = df["dispersion_norm"].values
             if n_top_genes is not None:
                 dispersion_norm = dispersion_norm[~np.isnan(dispersion_norm)]
@@ -777,9 +790,10 @@ def filter_and_normalize(
         Number of genes to keep.
     retain_genes: `list`, optional (default: `None`)
         List of gene names to be retained independent of thresholds.
-    flavor: {'seurat', 'cell_ranger', 'svr'}, optional (default: 'seurat')
+    flavor: {'seurat', 'seurat_v3', 'cell_ranger', 'svr'}, optional (default: 'seurat')
         Choose the flavor for computing normalized dispersion.
         If choosing 'seurat', this expects non-logarithmized data.
+        'seurat_v3' selects genes on raw counts, before normalization.
     log: `bool` (default: `True`)
         Take logarithm.
     layers_normalize: list of `str` (default: None)
@@ -812,11 +826,17 @@ def filter_and_normalize(
         retain_genes=retain_genes,
     )
 
+    if n_top_genes is not None and flavor == "seurat_v3":
+        # seurat_v3 expects raw counts, so genes are selected before normalization
+        filter_genes_dispersion(
+            adata, n_top_genes=n_top_genes, retain_genes=retain_genes, flavor=flavor
+        )
+
     if layers_normalize is not None and "enforce" not in kwargs:
         kwargs["enforce"] = True
     normalize_per_cell(adata, layers=layers_normalize, **kwargs)
 
-    if n_top_genes is not None:
+    if n_top_genes is not None and flavor != "seurat_v3":
         filter_genes_dispersion(
             adata, n_top_genes=n_top_genes, retain_genes=retain_genes, flavor=flavor
         )